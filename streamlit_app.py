@@ -1,41 +1,81 @@
 import streamlit as st
 import math
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-import matplotlib.cm as cm
-from matplotlib.colors import Normalize
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.colors import Normalize, to_rgba
+from matplotlib.text import Text
+from matplotlib.font_manager import FontProperties
 from io import BytesIO
 import os
+import re
 import json
 
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; fall back to unlocked updates
+    fcntl = None
+
 # Page config
 st.set_page_config(page_title="India Hex Map Visualizer", layout="wide")
 
 # Counter file path
 COUNTER_FILE = "map_counter.json"
 
+# Color schemes offered in the sidebar, limited to those this matplotlib ships
+_AVAILABLE_CMAPS = set(plt.colormaps())
+CMAP_OPTIONS = tuple(c for c in ("viridis", "plasma", "inferno", "magma", "cividis",
+                                 "Blues", "Reds", "Greens", "YlOrRd", "RdYlGn", "Spectral")
+                     if c in _AVAILABLE_CMAPS)
+DEFAULT_CMAP_INDEX = CMAP_OPTIONS.index("plasma") if "plasma" in CMAP_OPTIONS else 0
+
+# PNG resolutions offered for the map; the on-screen preview stays at
+# PREVIEW_DPI, which keeps it under st.image's 1460 px resize limit
+EXPORT_DPI_OPTIONS = (100, 150, 200, 300)
+PREVIEW_DPI = 150
+
+def _read_count(f):
+    """Read the count from an open counter file; bad contents count as 0."""
+    try:
+        data = json.load(f)
+    except ValueError:
+        return 0
+    count = data.get('count', 0) if isinstance(data, dict) else 0
+    if isinstance(count, bool) or not isinstance(count, (int, float)) or not math.isfinite(count):
+        return 0
+    return int(count)
+
 def get_counter():
     """Get current map counter."""
     try:
-        if os.path.exists(COUNTER_FILE):
-            with open(COUNTER_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get('count', 0)
-    except:
-        pass
-    return 0
+        with open(COUNTER_FILE, 'r') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_SH)
+            return _read_count(f)
+    except OSError:
+        return 0
 
 def increment_counter():
-    """Increment the global map counter."""
+    """Increment the global map counter.
+    
+    The read-modify-write happens under an exclusive lock on the counter
+    file, so concurrent sessions cannot lose each other's updates.
+    """
     try:
-        count = get_counter()
-        count += 1
-        with open(COUNTER_FILE, 'w') as f:
+        fd = os.open(COUNTER_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            count = _read_count(f) + 1
+            f.seek(0)
+            f.truncate()
             json.dump({'count': count}, f)
         return count
-    except:
+    except OSError:
         return None
 
 # Hex map configuration - embedded directly
@@ -79,36 +119,111 @@ HEX_MAP_KEY = """hex_id,code,state
 """
 
 
+# Fill color for hexes without a value
+MISSING_COLOR = to_rgba("lightgrey")
+
+# Font shared by all hex labels
+LABEL_FONT = FontProperties(size=9, weight="bold")
+
+# Unit offsets of the 6 corners of a flat-top hexagon
+HEX_ANGLES = np.deg2rad(60 * np.arange(6))
+HEX_COS = np.cos(HEX_ANGLES)
+HEX_SIN = np.sin(HEX_ANGLES)
+
 def hex_vertices(x, y, r=1):
-    """Return 6 vertices of a flat-top hexagon."""
-    return [(x + r * math.cos(math.radians(60 * i)), 
-             y + r * math.sin(math.radians(60 * i))) 
-            for i in range(6)]
+    """Return 6 vertices of flat-top hexagon(s) centered at x, y."""
+    x = np.asarray(x, dtype=float)[..., None]
+    y = np.asarray(y, dtype=float)[..., None]
+    return np.stack([x + r * HEX_COS, y + r * HEX_SIN], axis=-1)
 
+@st.cache_data(max_entries=16)
 def create_hex_grid(rows=10, cols=10, r=1):
-    """Create flat-top hex grid."""
+    """Create flat-top hex grid.
+    
+    Returns a DataFrame of compact per-hex scalars (int16 ids, float32
+    centers) and an (N, 6, 2) float32 vertex array indexed by hex_id.
+    """
     w = 2 * r
     h = math.sqrt(3) * r
     h_spacing = 3/4 * w
     v_spacing = h
     
-    hexes = []
-    for row in range(rows):
-        for col in range(cols):
-            cx = col * h_spacing
-            cy = row * v_spacing + (col % 2) * (v_spacing / 2)
-            hexes.append({
-                "hex_id": row * cols + col,
-                "cx": cx,
-                "cy": cy,
-                "verts": hex_vertices(cx, cy, r)
-            })
+    rr, cc = np.meshgrid(np.arange(rows), np.arange(cols), indexing="ij")
+    cx = (cc * h_spacing).ravel()
+    cy = (rr * v_spacing + (cc % 2) * (v_spacing / 2)).ravel()
+    
+    grid = pd.DataFrame({
+        "hex_id": (rr * cols + cc).ravel().astype(np.int16),
+        "row": rr.ravel().astype(np.int16),
+        "col": cc.ravel().astype(np.int16),
+        "cx": cx.astype(np.float32),
+        "cy": cy.astype(np.float32),
+    })
+    verts = hex_vertices(cx, cy, r).astype(np.float32)
     
-    return pd.DataFrame(hexes)
+    return grid, verts
 
+@st.cache_data
 def load_hex_mapping():
-    """Load embedded hex mapping."""
-    return pd.read_csv(BytesIO(HEX_MAP_KEY.encode()))
+    """Load embedded hex mapping, ordered by hex_id like the grid."""
+    mapping = pd.read_csv(BytesIO(HEX_MAP_KEY.encode()), dtype={"hex_id": np.int16, "code": "category"})
+    return mapping.sort_values("hex_id", ignore_index=True)
+
+@st.cache_data
+def load_hex_layout():
+    """Join the mapping onto the grid once; return mapped hexes and their vertices."""
+    hex_grid, hex_verts = create_hex_grid()
+    mapping = load_hex_mapping()
+    # hex_id is the row position in the grid, so geometry is a plain gather
+    hex_ids = mapping["hex_id"].to_numpy()
+    layout = mapping.assign(cx=hex_grid["cx"].to_numpy()[hex_ids],
+                            cy=hex_grid["cy"].to_numpy()[hex_ids])
+    return layout, hex_verts[hex_ids]
+
+@st.cache_data
+def load_hex_labels():
+    """Return (x, y, code) for every mapped hex that has a code to show."""
+    layout, _ = load_hex_layout()
+    layout = layout[layout["code"].notna() & (layout["code"] != "")]
+    return list(zip(layout["cx"].tolist(), layout["cy"].tolist(), layout["code"].tolist()))
+
+@st.cache_data(show_spinner=False)
+def load_uploaded_csv(raw_bytes):
+    """Parse an uploaded CSV, cached on its bytes so reruns skip the parse.
+    
+    Uses pyarrow's multithreaded parser, falling back to the C engine when
+    pyarrow is unavailable or rejects the file.
+    """
+    try:
+        data_df = pd.read_csv(BytesIO(raw_bytes), dtype={"code": "string"}, engine="pyarrow")
+    except (ImportError, ValueError):
+        data_df = pd.read_csv(BytesIO(raw_bytes), dtype={"code": "string"}, engine="c")
+    
+    # Accept headers like "Code" or " VALUE "; exact names win, and only the
+    # first other match is renamed so no duplicate labels appear
+    renames = {}
+    for col in data_df.columns:
+        key = str(col).strip().lower()
+        if key in ("code", "value") and key not in data_df.columns and key not in renames.values():
+            renames[col] = key
+    # Only code and value are used
+    return data_df.rename(columns=renames).filter(items=["code", "value"])
+
+_IN_PREFIX = re.compile(r"^IN-")
+
+def clean_codes(codes):
+    """Normalize state codes like 'IN-AP' or ' ap' to 'AP'.
+    
+    Anything that does not normalize to a known code becomes missing, so
+    entries like state names stay unmatched instead of hitting another state.
+    """
+    codes = codes.astype("string")
+    known = load_hex_mapping()["code"].cat.categories
+    # Template uploads are already clean; skip the string passes for them
+    if codes.isin(known).all():
+        return codes
+    cleaned = codes.str.strip().str.upper().str.replace(_IN_PREFIX, "", regex=True)
+    return cleaned.where(cleaned.isin(known))
 
 def create_template():
     """Create template CSV with state codes."""
@@ -117,56 +232,58 @@ def create_template():
     template["value"] = ""
     return template
 
-def plot_hex_map(data_df, cmap_name="plasma", map_title="India Hex Map", author_name=""):
-    """Plot hexagons colored by values."""
-    # Prepare hex grid with codes
-    hex_grid = create_hex_grid()
-    mapping = load_hex_mapping()
-    hex_data = hex_grid.merge(mapping, on="hex_id").merge(data_df, on="code", how="left")
+@st.cache_data
+def create_template_csv():
+    """Serialize the template to CSV bytes once for the download button."""
+    return create_template().to_csv(index=False).encode("utf-8")
+
+def plot_hex_map(data_df, cmap_name="plasma", map_title="India Hex Map", author_name="", ax=None):
+    """Plot hexagons colored by values, on a new figure unless ax is given."""
+    # Look up each mapped hex's value by code
+    hex_data, verts = load_hex_layout()
+    codes = hex_data["code"].to_numpy()
+    data_values = pd.to_numeric(data_df["value"], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    code_values = dict(zip(data_df["code"], data_values))
+    values = np.fromiter((code_values.get(c, np.nan) for c in codes), dtype=float, count=len(codes))
     
     # Setup colormap
-    valid_vals = hex_data["value"].dropna()
-    if len(valid_vals) == 0:
+    missing = np.isnan(values)
+    if missing.all():
         st.error("No valid numeric values found!")
         return None
     
-    vmin, vmax = valid_vals.min(), valid_vals.max()
-    cmap = plt.get_cmap(cmap_name)
+    vmin, vmax = np.nanmin(values), np.nanmax(values)
+    cmap = plt.get_cmap(cmap_name).with_extremes(bad=MISSING_COLOR)
     norm = Normalize(vmin=vmin, vmax=vmax)
     
-    # Create patches
-    patches = []
-    colors = []
-    for _, row in hex_data.iterrows():
-        poly = Polygon(row["verts"], closed=True, edgecolor="black", linewidth=0.5)
-        patches.append(poly)
-        
-        if pd.notna(row["value"]):
-            colors.append(cmap(norm(row["value"])))
-        else:
-            colors.append("lightgrey")
-    
     # Plot
-    fig, ax = plt.subplots(figsize=(12, 10))
-    collection = PatchCollection(patches, facecolor=colors, match_original=True)
-    ax.add_collection(collection)
+    if ax is None:
+        # A bare Figure stays out of pyplot's global registry, so nothing leaks
+        fig = Figure(figsize=(12, 10))
+        ax = fig.add_subplot()
+    else:
+        fig = ax.figure
+    # One collection for all hexagons; it maps values to colors in a single
+    # batch and doubles as the colorbar's mappable
+    collection = PolyCollection(verts, array=np.ma.masked_array(values, missing),
+                                cmap=cmap, norm=norm, edgecolors="black", linewidths=0.5)
+    ax.add_collection(collection, autolim=False)
     
     # Add state code labels
-    for _, row in hex_data.iterrows():
-        if pd.notna(row["code"]):
-            ax.text(row["cx"], row["cy"], row["code"], 
-                   ha="center", va="center", fontsize=9, weight='bold')
+    for x, y, code in load_hex_labels():
+        ax.add_artist(Text(x, y, code, ha="center", va="center", fontproperties=LABEL_FONT))
     
+    # Fit the view to the hexagons with a 5% margin
+    (xmin, ymin), (xmax, ymax) = verts.min(axis=(0, 1)), verts.max(axis=(0, 1))
+    pad_x, pad_y = 0.05 * (xmax - xmin), 0.05 * (ymax - ymin)
+    ax.set_xlim(xmin - pad_x, xmax + pad_x)
+    ax.set_ylim(ymin - pad_y, ymax + pad_y)
     ax.set_aspect("equal")
-    ax.autoscale()
-    ax.margins(0.05)
     ax.axis("off")
     ax.set_title(map_title, fontsize=18, pad=20, weight='bold')
     
     # Colorbar
-    sm = cm.ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array(valid_vals)
-    cbar = fig.colorbar(sm, ax=ax, fraction=0.046, pad=0.04)
+    cbar = fig.colorbar(collection, ax=ax, fraction=0.046, pad=0.04)
     cbar.set_label("Value", fontsize=12)
     
     # Add caption
@@ -175,6 +292,27 @@ def plot_hex_map(data_df, cmap_name="plasma", map_title="India Hex Map", author_
     
     return fig
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def render_map_png(data_df, cmap_name, map_title, author_name, dpi=PREVIEW_DPI):
+    """Render the map once and return (preview, export) PNG bytes.
+    
+    The preview is saved at PREVIEW_DPI for display and the export at the
+    requested DPI for download; both are cached on the inputs.
+    """
+    fig = plot_hex_map(data_df, cmap_name=cmap_name, map_title=map_title, author_name=author_name)
+    if fig is None:
+        return None
+    
+    def save(save_dpi):
+        img_buffer = BytesIO()
+        # Flat-colored maps compress well even at zlib's fastest level
+        fig.savefig(img_buffer, format='png', dpi=save_dpi, bbox_inches='tight',
+                    pil_kwargs={"compress_level": 1})
+        return img_buffer.getvalue()
+    
+    preview = save(PREVIEW_DPI)
+    return preview, (preview if dpi == PREVIEW_DPI else save(dpi))
+
 # Main app
 st.title("🗺️ India Hex Map Visualizer")
 st.markdown("Create beautiful hexagonal choropleth maps for Indian states in 2 simple steps • [Made by Akshar Katariya](https://aksharkatariya.github.io)")
@@ -183,12 +321,10 @@ st.markdown("Create beautiful hexagonal choropleth maps for Indian states in 2 s
 with st.sidebar:
     st.header("⚙️ Customization")
     
-    cmap_options = ["viridis", "plasma", "inferno", "magma", "cividis", 
-                   "Blues", "Reds", "Greens", "YlOrRd", "RdYlGn", "Spectral"]
     cmap = st.selectbox(
         "Color scheme",
-        cmap_options,
-        index=1,
+        CMAP_OPTIONS,
+        index=DEFAULT_CMAP_INDEX,
         help="Choose a color palette for your map"
     )
     
@@ -204,10 +340,19 @@ with st.sidebar:
         help="Your name will appear in the map caption"
     )
     
+    export_dpi = st.selectbox(
+        "Export DPI",
+        EXPORT_DPI_OPTIONS,
+        index=EXPORT_DPI_OPTIONS.index(150),
+        help="Higher DPI gives a sharper PNG for print but takes longer to generate"
+    )
+    
     # Display counter
     st.markdown("---")
-    counter = get_counter()
-    st.metric("Maps Created", f"{counter:,}")
+    # Read the shared file once per session; this session's own maps keep it current
+    if "map_count" not in st.session_state:
+        st.session_state.map_count = get_counter()
+    st.metric("Maps Created", f"{st.session_state.map_count:,}")
     
    # Support section in sidebar
     st.markdown("---")
@@ -224,16 +369,11 @@ with st.sidebar:
 with st.container():
     st.markdown("### 📥 Step 1: Download Template")
     
-    template = create_template()
-    csv_buffer = BytesIO()
-    template.to_csv(csv_buffer, index=False)
-    csv_buffer.seek(0)
-    
     col1, col2 = st.columns([1, 2])
     with col1:
         st.download_button(
             label="📄 Download Template CSV",
-            data=csv_buffer,
+            data=create_template_csv(),
             file_name="india_hex_map_template.csv",
             mime="text/csv",
             use_container_width=True,
@@ -256,13 +396,15 @@ with st.container():
 
     if data_file:
         try:
-            data_df = pd.read_csv(data_file)
+            data_df = load_uploaded_csv(data_file.getvalue())
             
             # Validate
-            if "code" not in data_df.columns or "value" not in data_df.columns:
-                st.error("❌ CSV must contain 'code' and 'value' columns")
+            missing_cols = {"code", "value"} - set(data_df.columns)
+            if missing_cols:
+                st.error(f"❌ CSV must contain 'code' and 'value' columns (missing: {', '.join(sorted(missing_cols))})")
             else:
                 # Clean data
+                data_df["code"] = clean_codes(data_df["code"])
                 data_df["value"] = pd.to_numeric(data_df["value"], errors="coerce")
                 data_df = data_df[data_df["value"].notna()]
                 
@@ -270,40 +412,41 @@ with st.container():
                     st.error("❌ No valid numeric values found in 'value' column")
                 else:
                     # Show statistics
+                    values = data_df["value"].to_numpy(dtype=float)
                     st.markdown("#### 📊 Data Summary")
                     col1, col2, col3 = st.columns(3)
                     with col1:
                         st.metric("States/UTs", len(data_df))
                     with col2:
-                        st.metric("Minimum Value", f"{data_df['value'].min():.2f}")
+                        st.metric("Minimum Value", f"{values.min():.2f}")
                     with col3:
-                        st.metric("Maximum Value", f"{data_df['value'].max():.2f}")
+                        st.metric("Maximum Value", f"{values.max():.2f}")
                     
                     # Plot
                     st.markdown("---")
                     st.markdown("#### 🗺️ Your Map")
                     
                     with st.spinner("Generating your map..."):
-                        fig = plot_hex_map(data_df, cmap_name=cmap, map_title=map_title, author_name=author_name)
+                        pngs = render_map_png(data_df[["code", "value"]], cmap, map_title, author_name, export_dpi)
                     
-                    if fig:
+                    if pngs:
+                        preview_png, export_png = pngs
+                        
                         # Increment counter when map is successfully generated
-                        increment_counter()
+                        count = increment_counter()
+                        if count is not None:
+                            st.session_state.map_count = count
                         
-                        st.pyplot(fig)
+                        st.image(preview_png, use_column_width=True)
                         
                         # Download
-                        img_buffer = BytesIO()
-                        fig.savefig(img_buffer, format='png', dpi=300, bbox_inches='tight')
-                        img_buffer.seek(0)
-                        
                         st.download_button(
-                            label="💾 Download Map (High Resolution PNG)",
-                            data=img_buffer,
+                            label=f"💾 Download Map (PNG, {export_dpi} DPI)",
+                            data=export_png,
                             file_name="india_hex_map.png",
                             mime="image/png",
                             use_container_width=True,
-                            help="Download your map as a high-resolution PNG image (300 DPI)"
+                            help=f"Download your map as a PNG image ({export_dpi} DPI)"
                         )
                         
                         st.success("✅ Map generated successfully!")